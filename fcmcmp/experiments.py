@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 
-import sys, re, yaml, logging, fcsparser, subprocess
+import os, sys, yaml, logging, subprocess
+import numpy as np
 from pathlib import Path
+from itertools import islice, chain, repeat
+from functools import partial
+from fnmatch import fnmatch
+from concurrent.futures import ProcessPoolExecutor
 from natsort import natsorted
-from pprint import pprint
+from fcsparser.api import FCSParser
+
+try:
+    from yaml import CSafeLoader as _Loader, CSafeDumper as _Dumper
+except ImportError:
+    from yaml import SafeLoader as _Loader, SafeDumper as _Dumper
 
 def parse_well_label(label):
     fields = label.rsplit('/', 1)
@@ -12,18 +22,67 @@ def parse_well_label(label):
     else:
         return fields
 
-def load_experiments(config_path, well_glob='**/*_{}*.fcs'):
-    config_path = Path(config_path)
+def _parse_fcs(path, dtype):
+    # Use the parser directly rather than fcsparser.parse(), which always 
+    # converts (and therefore copies) the data, even when the file already 
+    # stores values of the requested type.  Single precision is plenty for 
+    # cytometry data and halves the memory used by each well, but callers can 
+    # ask for float64, or for the types stored in the file (dtype=None).
+
+    parser = FCSParser(path)
+    meta, data = parser.annotation, parser.dataframe
+
+    if dtype is not None and (data.dtypes != dtype).any():
+        data = data.astype(dtype)
+
+    return meta, data
 
+def _intern_meta(meta):
+    # Intern the metadata strings.  Most of the keys (and many of the values) 
+    # are the same for every well, so this lets all the wells share them.
+
+    intern = lambda x: sys.intern(x) if isinstance(x, str) else x
+    return {intern(k): intern(v) for k, v in meta.items()}
+
+def _iter_documents(config_path, cache=False):
     if config_path.suffix == '.py':
-        py_command = 'python', str(config_path)
-        yml_config = subprocess.check_output(py_command)
-        documents = list(yaml.load_all(yml_config))
+        # If the caller asks for it, cache the YAML generated by the script in 
+        # a file next to it, so the script only has to be run again if it has 
+        # been modified since the cache was written.  This is off by default, 
+        # because only the script itself is checked: the cache goes stale if 
+        # the script depends on anything else (e.g. other modules or files).
+
+        cache_path = config_path.with_suffix('.py.yml')
+
+        if cache and cache_path.exists() and \
+                cache_path.stat().st_mtime >= config_path.stat().st_mtime:
+            yml_config = cache_path.read_bytes()
+        else:
+            py_command = 'python', str(config_path)
+            yml_config = subprocess.check_output(py_command)
+            if cache:
+                try:
+                    cache_path.write_bytes(yml_config)
+                except OSError:
+                    pass
+
+        yield from yaml.load_all(yml_config, Loader=_Loader)
     else:
-        with config_path.open() as file:
-            documents = list(yaml.load_all(file))
+        # Open the file in binary mode, so the parser detects the encoding 
+        # (UTF-8 or UTF-16) itself, rather than depending on the locale.
+
+        with config_path.open('rb') as file:
+            yield from yaml.load_all(file, Loader=_Loader)
+
+def _read_plates(config_path, cache=False):
+    # Parse the documents lazily, so that each experiment can be processed 
+    # (and its YAML nodes discarded) before the next one is read.  The header 
+    # documents are pulled off the front of the stream as needed.
+
+    documents = _iter_documents(config_path, cache)
+    head = list(islice(documents, 1))
 
-    if not documents:
+    if not head:
         raise UsageError("'{}' is empty.".format(config_path))
 
     # Find the *.fcs data files relevant to this experiment.  If there is a 
@@ -41,48 +100,138 @@ def load_experiments(config_path, well_glob='**/*_{}*.fcs'):
         return Path(s) if Path(s).is_absolute() else config_path.parent/s
 
     def clean_up_plate_document():
-        if len(documents[0]) > 1:
+        if len(head[0]) > 1:
             raise UsageError("Too many fields in 'plates' header.")
-        del documents[0]
+        head.pop()
 
 
-    if 'plates' in documents[0]:
-        plates = {k: str_to_path(v) for k,v in documents[0]['plates'].items()}
+    if 'plates' in head[0]:
+        plates = {k: str_to_path(v) for k,v in head[0]['plates'].items()}
         clean_up_plate_document()
-    elif 'plate' in documents[0]:
-        plates = {None: str_to_path(documents[0]['plate'])}
+    elif 'plate' in head[0]:
+        plates = {None: str_to_path(head[0]['plate'])}
         clean_up_plate_document()
     elif inferred_path.is_dir():
         plates = {None: inferred_path}
     else:
         plates = {}
 
+    return plates, chain(head, documents)
+
+def _read_defaults(documents):
     # If the first document (after the plate document, if there was one) is a 
     # mapping without a label entry, treat it as a set of default values to 
     # include in every other document.
 
-    if len(documents) > 1 and 'label' not in documents[0]:
-        defaults = documents[0]
-        del documents[0]
+    head = list(islice(documents, 2))
+
+    if len(head) > 1 and 'label' not in head[0]:
+        defaults = head.pop(0)
     else:
         defaults = {}
 
+    return defaults, chain(head, documents)
+
+def load_plates(config_path, cache=False):
+    # Only the header documents are parsed, so this is cheap even for large 
+    # config files.
+
+    plates, documents = _read_plates(Path(config_path), cache)
+    return plates
+
+def iter_experiment_labels(config_path, cache=False):
+    # Yield the label of each experiment without finding or parsing any of the 
+    # *.fcs files it refers to.
+
+    _, documents = _read_plates(Path(config_path), cache)
+    _, documents = _read_defaults(documents)
+
+    for experiment in documents:
+        if not experiment:
+            raise UsageError("An empty experiment was found.\nDid you accidentally leave '---' at the end of the file?")
+        if 'label' not in experiment:
+            raise UsageError("The following experiment is missing a label:\n\n{}".format(yaml.dump(experiment, Dumper=_Dumper)))
+
+        yield experiment.get('relabel', experiment['label'])
+
+def load_experiments(config_path, well_glob='**/*_{}*.fcs', workers=1,
+        dtype='float32', lazy=False, cache=False):
+    config_path = Path(config_path)
+    plates, documents = _read_plates(config_path, cache)
+    defaults, documents = _read_defaults(documents)
+
     # Construct and fill in a list of experiments.  Well names are converted 
     # into paths based on the user-given glob pattern, then parsed and stored 
-    # as pandas data frames.  Note that if a well is referenced more than once, 
-    # it will also be parsed more than once.  This guarantees that each well 
-    # can be processed independently, which is important for many workflows.
+    # as pandas data frames.  Each *.fcs file is only parsed once, but if a 
+    # well is referenced more than once, each reference gets its own copy of 
+    # the parsed data.  This guarantees that each well can be processed 
+    # independently, which is important for many workflows.
 
     experiments = []
     includes = {}
+    listings = {}
+    indices = {}
+    found_wells = {}
+
+    def glob_plate(plate_path, well):
+        # List the files in each plate directory only once, then match wells 
+        # against that listing in memory.  This avoids walking the whole 
+        # directory tree again for every well.
+
+        dir_glob, _, name_glob = well_glob.format(well).rpartition('/')
+        key = plate_path, dir_glob
+
+        if key not in listings:
+            listings[key] = list(plate_path.glob(dir_glob + '/*' if dir_glob else '*'))
+
+        # If the files are named using the default scheme, index the listing 
+        # once so that each well can be found with a single dict lookup.  
+        # Otherwise, check each file against the pattern for this well.
+
+        if well_glob.rpartition('/')[2] == '*_{}*.fcs' and \
+                well and not set(well) & set('_*?['):
+
+            if key not in indices:
+                indices[key] = index_listing(listings[key])
+
+            return indices[key].get(os.path.normcase(well), [])
+
+        return [x for x in listings[key] if fnmatch(x.name, name_glob)]
+
+    def index_listing(paths):
+        # A file name matches '*_{}*.fcs' exactly when the well name is a 
+        # prefix of one of the underscore-delimited fields in its stem (not 
+        # counting the first field, which isn't preceded by an underscore).  
+        # So index every file by every such prefix.
+
+        index = {}
+
+        for path in paths:
+            name = os.path.normcase(path.name)
+            if not name.endswith('.fcs'):
+                continue
+
+            fields = name[:-len('.fcs')].split('_')[1:]
+            prefixes = {x[:i] for x in fields for i in range(1, len(x) + 1)}
+
+            for prefix in prefixes:
+                index.setdefault(prefix, []).append(path)
 
-    def load_well(label):
+        return index
+
+    def find_well(label):
         # Short-circuit the case where the well has already been loaded, which 
         # is triggered by the "from" external reference machinery.
 
         if isinstance(label, Well):
             return label
 
+        # Only look for the *.fcs file once per label, no matter how many 
+        # times the label is referenced.
+
+        if label in found_wells:
+            return found_wells[label]
+
         # Parse well and plate names from the given label.  The plate name is 
         # optional, because often there is only one.
 
@@ -97,19 +246,32 @@ def load_experiments(config_path, well_glob='**/*_{}*.fcs'):
                     "No default plate defined for well '{}'.".format(label))
 
         plate_path = plates[plate]
-        well_paths = list(plate_path.glob(well_glob.format(well)))
+        well_paths = glob_plate(plate_path, well)
         glob_str = str(plate_path / well_glob.format(well))  # For error messages
         if len(well_paths) == 0:
             raise UsageError("No *.fcs files found for well '{}' matching {}".format(label, glob_str))
         if len(well_paths) > 1:
             raise UsageError("Multiple *.fcs files found for well '{}' matching {}".format(label, glob_str))
-        well_path = well_paths[0]
 
-        # Load the cell data for the given well.
-        
-        logging.info('Loading {}'.format(well_path.name))
-        meta, data = fcsparser.parse(str(well_path))
-        return Well(label, meta, data)
+        found_wells[label] = label, str(well_paths[0])
+        return found_wells[label]
+
+    def load_well(well):
+        if isinstance(well, Well):
+            return well
+
+        label, well_path = well
+
+        if lazy:
+            return Well(label, loader=partial(parse_well, well_path))
+
+        meta, data = parsed[well_path]
+        return Well(label, meta.copy(), data.copy())
+
+    def parse_well(well_path):
+        logging.info('Loading {}'.format(Path(well_path).name))
+        meta, data = _parse_fcs(well_path, dtype)
+        return _intern_meta(meta), data
 
 
     for experiment in documents:
@@ -122,7 +284,11 @@ def load_experiments(config_path, well_glob='**/*_{}*.fcs'):
         if 'from' in experiment:
             referenced_experiment = load_experiment(
                     config_path.parent / experiment['from'],
-                    experiment['label'])
+                    experiment['label'],
+                    workers=workers,
+                    dtype=dtype,
+                    lazy=lazy,
+                    cache=cache)
 
             experiment.update(referenced_experiment)
 
@@ -133,15 +299,15 @@ def load_experiments(config_path, well_glob='**/*_{}*.fcs'):
         # value pairs can be present but are not required.
 
         if 'label' not in experiment:
-            raise UsageError("The following experiment is missing a label:\n\n{}".format(yaml.dump(experiment)))
+            raise UsageError("The following experiment is missing a label:\n\n{}".format(yaml.dump(experiment, Dumper=_Dumper)))
         if 'wells' not in experiment:
-            raise UsageError("The following experiment doesn't have any wells:\n\n{}".format(yaml.dump(experiment)))
+            raise UsageError("The following experiment doesn't have any wells:\n\n{}".format(yaml.dump(experiment, Dumper=_Dumper)))
 
-        # Set the well data for the comparison.  This requires converting the 
-        # well names we were given into paths and parsing those files.
+        # Find the *.fcs file for each well.  The files themselves are parsed 
+        # below, once every experiment has been read.
 
         for well_type, well_names in experiment['wells'].items():
-            experiment['wells'][well_type] = [load_well(x) for x in well_names]
+            experiment['wells'][well_type] = [find_well(x) for x in well_names]
 
         # Fill in any default values.
 
@@ -151,10 +317,50 @@ def load_experiments(config_path, well_glob='**/*_{}*.fcs'):
 
         experiments.append(experiment)
 
+    # Parse every *.fcs file that was referenced.  The files are independent 
+    # of each other, so they can be parsed in parallel if the user asks for 
+    # more than one worker.  This isn't the default because worker processes 
+    # can re-import the calling script on some platforms, which requires 
+    # scripts to have an `if __name__ == '__main__'` guard.  If the user asks 
+    # for lazy loading, skip this step entirely: each well will parse its own 
+    # file the first time its data or metadata are accessed.
+
+    well_paths = sorted({
+            well[1]
+            for experiment in experiments
+            for wells in experiment['wells'].values()
+            for well in wells
+            if not isinstance(well, Well)
+    })
+
+    if lazy:
+        parsed = {}
+
+    elif workers == 1 or len(well_paths) < 2:
+        parsed = {x: parse_well(x) for x in well_paths}
+
+    else:
+        for well_path in well_paths:
+            logging.info('Loading {}'.format(Path(well_path).name))
+
+        with ProcessPoolExecutor(workers) as executor:
+            parsed = dict(zip(well_paths, executor.map(
+                    _parse_fcs, well_paths, repeat(dtype))))
+
+        for well_path, (meta, data) in parsed.items():
+            parsed[well_path] = _intern_meta(meta), data
+
+    for experiment in experiments:
+        for well_type, wells in experiment['wells'].items():
+            experiment['wells'][well_type] = [load_well(x) for x in wells]
+
     return experiments
         
-def load_experiment(config_path, experiment_label, well_glob='**/*_{}*.fcs'):
-    experiments = load_experiments(config_path, well_glob=well_glob)
+def load_experiment(config_path, experiment_label, well_glob='**/*_{}*.fcs',
+        workers=1, dtype='float32', lazy=False, cache=False):
+    experiments = load_experiments(
+            config_path, well_glob=well_glob, workers=workers, dtype=dtype,
+            lazy=lazy, cache=cache)
     for experiment in experiments:
         if experiment['label'] == experiment_label:
             return experiment
@@ -162,15 +368,51 @@ def load_experiment(config_path, experiment_label, well_glob='**/*_{}*.fcs'):
         
 
 class Well:
+    __slots__ = ('label', '_meta', '_data', '_loader')
 
-    def __init__(self, label, meta, data):
+    def __init__(self, label, meta=None, data=None, loader=None):
         self.label = label
-        self.meta = meta
-        self.data = data
+        self._meta = meta
+        self._data = data
+        self._loader = loader
 
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, self.label)
 
+    @property
+    def meta(self):
+        self._load()
+        return self._meta
+
+    @meta.setter
+    def meta(self, meta):
+        self._meta = meta
+
+    @property
+    def data(self):
+        self._load()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    def _load(self):
+        # If a loader was given, use it to fill in the metadata and data the 
+        # first time either is needed.  Anything that was set explicitly in 
+        # the meantime is left alone.
+
+        if self._loader is None:
+            return
+
+        meta, data = self._loader()
+        self._loader = None
+
+        if self._meta is None:
+            self._meta = meta
+        if self._data is None:
+            self._data = data
+
     def __lt__(self, other):
         return self.label < other.label
 
@@ -231,14 +473,19 @@ def define_96_well_plates(define_well, define_experiment=lambda expt: None,
     # labels and a condition with each one.
 
     experiments = []
+    experiments_by_label = {}
+
+    # Figure out which row, column, and plate each index refers to.
 
-    for i in range(96 * len(plates)):
+    indices = np.arange(96 * len(plates))
+    rows = (indices // divisors['row']) % strides['row']
+    cols = (indices // divisors['col']) % strides['col']
+    plate_indices = (indices // divisors['plate']) % strides['plate']
 
-        # Figure out which row, column, and plate this index refers to.
+    for i, row, col, plate_index in zip(
+            indices.tolist(), rows.tolist(), cols.tolist(), plate_indices.tolist()):
 
-        row = (i // divisors['row']) % strides['row']
-        col = (i // divisors['col']) % strides['col']
-        plate = plate_order[(i // divisors['plate']) % strides['plate']]
+        plate = plate_order[plate_index]
 
         # Get the experiment and condition to associate with this well from the 
         # user.  Skip this well if define_well() returns None.
@@ -255,16 +502,14 @@ def define_96_well_plates(define_well, define_experiment=lambda expt: None,
         # Otherwise create an empty experiment data structure and add 
         # it to the list of experiments.
 
-        try:
-            experiment = next(
-                    expt for expt in experiments
-                    if expt['label'] == label)
+        experiment = experiments_by_label.get(label)
 
-        except StopIteration:
+        if experiment is None:
             experiment = extra_params.copy()
             experiment['label'] = label
             experiment['wells'] = {}
             experiments.append(experiment)
+            experiments_by_label[label] = experiment
 
         # Associate this well with the given condition.
 
@@ -302,7 +547,7 @@ Options:
     # default indentation algorithm.
 
     dump_config = lambda **kwargs: '---\n'.join(
-            yaml.dump(x, **kwargs) for x in header + experiments)
+            yaml.dump(x, Dumper=_Dumper, **kwargs) for x in header + experiments)
 
     if args['--output']:
         
@@ -315,7 +560,10 @@ Options:
     else:
         print(dump_config())
 
+_row_indices = {x: i for i, x in enumerate('ABCDEFGH')}
+
 class WellCursor96:
+    __slots__ = ('_index', '_row', '_col', '_plate', '_row_abc', '_label')
 
     def __init__(self, index, row, col, plate):
         self._index = index
@@ -323,6 +571,15 @@ class WellCursor96:
         self._col = col
         self._plate = plate
 
+        # The label is read every time the cursor is printed or compared, so 
+        # format it once up front.
+
+        self._row_abc = 'ABCDEFGH'[row]
+        self._label = '{}{:02d}'.format(self._row_abc, col + 1)
+
+        if plate:
+            self._label = '{}/{}'.format(plate, self._label)
+
     def __repr__(self):
         return self.label
 
@@ -333,13 +590,14 @@ class WellCursor96:
 
         except AttributeError:
             other_plate, other_well = parse_well_label(str(other))
-            other_well_match = re.match('([A-H])([0-9]{1,2})', other_well)
+            other_row_abc, other_col_str = other_well[:1], other_well[1:]
 
-            if not other_well_match:
+            if other_row_abc not in _row_indices or \
+                    not other_col_str.isdecimal() or len(other_col_str) > 2:
                 raise UsageError("can't compare {} to {}".format(other, self))
 
-            other_row = list('ABCDEFGH').index(other_well_match.group(1))
-            other_col = int(other_well_match.group(2)) - 1
+            other_row = _row_indices[other_row_abc]
+            other_col = int(other_col_str) - 1
 
             return (self.row, self.col, self.plate) == \
                    (other_row, other_col, other_plate)
@@ -354,7 +612,7 @@ class WellCursor96:
 
     @property
     def row_abc(self):
-        return 'ABCDEFGH'[self.row]
+        return self._row_abc
 
     @property
     def col(self):
@@ -366,12 +624,7 @@ class WellCursor96:
 
     @property
     def label(self):
-        label = '{}{:02d}'.format(self.row_abc, self.col + 1)
-
-        if self.plate:
-            label = '{}/{}'.format(self.plate, label)
-
-        return label
+        return self._label
 
 
 
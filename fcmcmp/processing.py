@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
 def yield_wells(experiments, keyword=None):
     for experiment in experiments:
@@ -21,12 +26,130 @@ def yield_unique_wells(experiments, keyword=None):
             yield experiment, condition, well
 
 def clear_all_processing_steps():
-    global _all_processing_steps
-    _all_processing_steps = []
-
-def run_all_processing_steps(experiments):
-    for step in _all_processing_steps:
-        step(experiments)
+    # Clear the list in place, so any references to it (e.g. held by code 
+    # that imported it directly) don't go on running stale steps.
+    _all_processing_steps.clear()
+
+def run_all_processing_steps(experiments, workers=1, steps=None):
+    # By default, run every step that has been created (and not cleared).  
+    # Callers can instead pass the steps to run explicitly, which doesn't 
+    # depend on (or pick up stale steps from) the global registry.  The same 
+    # step object is never run twice.
+    #
+    # Apply every step to one well before moving on to the next, so that each 
+    # well's data only has to be brought into the cache once, rather than 
+    # once per step.  Only steps that set `fusable` are run like this.  Any 
+    # other step (e.g. one whose process_well() looks at other wells in the 
+    # same experiment) is run on its own over every well, in order.
+    #
+    # If `workers` is greater than 1, the fused steps are applied to that many 
+    # wells at once in separate threads.  The same caveats apply as for 
+    # ProcessingStep.workers: the steps must be thread-safe, and no well 
+    # object can appear more than once.
+
+    fused_steps = []
+
+    if steps is None:
+        steps = _all_processing_steps
+
+    unique_steps = list({id(x): x for x in steps}.values())
+
+    for step in _schedule_steps(unique_steps):
+        if _is_fusable(step):
+            fused_steps.append(step)
+        else:
+            _run_fused_steps(fused_steps, experiments, workers)
+            fused_steps = []
+            step(experiments)
+
+    _run_fused_steps(fused_steps, experiments, workers)
+
+def _schedule_steps(steps):
+    # Move each gate ahead of any transformations it doesn't depend on, so 
+    # that the transformations only have to process the events that survive 
+    # the gate.  Gates are never moved past each other, or past any step that 
+    # doesn't know how it interacts with gates, so the result is the same as 
+    # running the steps in the order they were created.
+    schedule = []
+
+    for step in steps:
+        i = len(schedule)
+        while i > 0 and _can_run_before(step, schedule[i-1]):
+            i -= 1
+        schedule.insert(i, step)
+
+    return schedule
+
+def _can_run_before(gate, transform):
+    return gate.kind == 'gate' and transform.kind == 'transform' and \
+           gate.can_reorder and transform.can_reorder and \
+           transform.commutes_with(gate.channels_read())
+
+def _is_fusable(step):
+    cls = step.__class__
+    return step.fusable and \
+           cls.__call__ is ProcessingStep.__call__ and \
+           cls.process_experiment is ProcessingStep.process_experiment
+
+def _run_fused_steps(steps, experiments, workers=1):
+    # Consecutive gates that only look at one event at a time give the same 
+    # result whether they're applied one after another or all to the original 
+    # data, so combine their masks and only copy the data frame once.
+    groups = []
+
+    for step in steps:
+        if groups and _is_row_local_gate(step) and \
+                _is_row_local_gate(groups[-1][-1]):
+            groups[-1].append(step)
+        else:
+            groups.append([step])
+
+    def update_well(experiment, well):
+        for group in groups:
+            if len(group) == 1:
+                processed_data = group[0].process_well(experiment, well)
+            else:
+                processed_data = _apply_gates(group, experiment, well)
+            if processed_data is not None:
+                well.data = processed_data
+
+    if not groups:
+        return
+
+    experiment_wells = [
+            (experiment, well)
+            for experiment in experiments
+            for wells in experiment['wells'].values()
+            for well in wells
+    ]
+
+    if workers == 1:
+        for experiment, well in experiment_wells:
+            update_well(experiment, well)
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(lambda x: update_well(*x), experiment_wells))
+
+def _is_row_local_gate(step):
+    return step.kind == 'gate' and step.row_local
+
+def _apply_gates(gates, experiment, well):
+    if well.data.empty:
+        return
+
+    discard = np.zeros(len(well.data), dtype=bool)
+
+    for gate in gates:
+        selection = gate.gate(experiment, well)
+        if selection is None:
+            continue
+
+        num_events = len(discard) - discard.sum() if gate.verbose else None
+        discard |= gate.check_selection(well, selection)
+        if gate.verbose:
+            gate.report(well, len(discard) - discard.sum(), num_events)
+
+    return well.data.iloc[~discard]
 
 _all_processing_steps = []
 
@@ -40,9 +163,20 @@ class ProcessingStep:
     can contain a number of flow cytometry data frames.  Iterating through all 
     of them to apply a common transformation is common enough that it was worth 
     supporting with a bit of a framework, and that's what this class is.
+
+    Set `fusable` if process_well() only looks at the well it's given.  This 
+    allows run_all_processing_steps() to apply the step to each well together 
+    with the steps around it, rather than to every well before moving on.
+
+    run_all_processing_steps() may run gates ahead of transformations that 
+    were created before them, but only if both steps set `can_reorder` and the 
+    transformation's commutes_with() says that the gate doesn't depend on it.
     """
+    kind = None
+    fusable = False
+    can_reorder = False
 
-    def __new__(cls):
+    def __new__(cls, *args, **kwargs):
         """
         Keep track of all the processing steps that get instantiated.  This 
         functionality is required by run_all_processing_steps().
@@ -52,6 +186,7 @@ class ProcessingStep:
         # method.
         step = super().__new__(cls)
         step.verbose = False
+        step.workers = 1
         _all_processing_steps.append(step)
         return step
 
@@ -75,12 +210,26 @@ class ProcessingStep:
         abstract method.  If process_well() returns a data frame, it replaces 
         the existing well data.  If process_well() returns None, it is assumed 
         that the well data was modified in place.
+
+        If `workers` is greater than 1, the wells are processed concurrently 
+        in that many threads.  The numpy and pandas operations used by the 
+        built-in steps release the GIL for most of their work, so this can 
+        help with large wells.  Only enable it for steps whose process_well() 
+        is thread-safe, and only if no well object appears more than once.
         """
-        for condition, wells in experiment['wells'].items():
-            for i, well in enumerate(wells):
-                processed_data = self.process_well(experiment, well)
-                if processed_data is not None:
-                    experiment['wells'][condition][i].data = processed_data
+        def update_well(well):
+            processed_data = self.process_well(experiment, well)
+            if processed_data is not None:
+                well.data = processed_data
+
+        wells = [x for wells in experiment['wells'].values() for x in wells]
+
+        if self.workers == 1:
+            for well in wells:
+                update_well(well)
+        else:
+            with ThreadPoolExecutor(self.workers) as executor:
+                list(executor.map(update_well, wells))
 
     def process_well(self, experiment, well):   # (abstract)
         """
@@ -92,6 +241,13 @@ class ProcessingStep:
         """
         raise NotImplementedError(self.__class__.__name__)
 
+    def commutes_with(self, channels):
+        """
+        Return true if this step doesn't affect a gate that reads the given 
+        channels.  A value of None means the gate may read any channel.
+        """
+        return False
+
 
 class KeepRelevantChannels(ProcessingStep):
     """
@@ -102,74 +258,287 @@ class KeepRelevantChannels(ProcessingStep):
     for whatever reason.
     """
 
+    kind = 'transform'
+    fusable = True
+    can_reorder = True
+
     def __init__(self, channels=None):
-        self.channels = None
+        self.channels = channels
 
     def process_well(self, experiment, well):
+        # Don't copy the data frame if there's nothing to discard.
+        if self.channels is None or \
+                list(well.data.columns) == list(self.channels):
+            return
+
         return well.data.reindex(columns=self.channels)
 
+    def commutes_with(self, channels):
+        if self.channels is None:
+            return True
+        return channels is not None and set(channels) <= set(self.channels)
+
 
 class LogTransformation(ProcessingStep):
+    kind = 'transform'
+    fusable = True
+    can_reorder = True
 
-    def __init__(self, channels=None):
+    def __init__(self, channels=None, use_log1p=False):
         self.channels = channels or []
+        self.use_log1p = use_log1p
 
     def process_well(self, experiment, well):
-        for channel in self.channels:
-            if channel in well.data.columns:
-                well.data[channel] = np.log10(well.data[channel])
+        channels = [x for x in self.channels if x in well.data.columns]
+
+        if not channels or well.data.empty:
+            return
+
+        for group, block in _float_blocks(well.data, channels):
+            _log10_in_place(block, self.use_log1p)
+            well.data[group] = block
+
+    def commutes_with(self, channels):
+        return channels is not None and not set(channels) & set(self.channels)
 
 
 class GatingStep(ProcessingStep):
+    """
+    Discard events that fall outside of some gate.
+
+    Subclasses implement gate(), which should return a boolean array with one 
+    entry per event, true for the events to discard.  Computing that array 
+    with whole-column numpy expressions (e.g. `well.data['FSC-A'].to_numpy() 
+    < 1000`) is much faster than looping over events in python.  If a gate 
+    really needs a per-event loop, compile that loop (e.g. with numba) and 
+    call it on the raw numpy arrays rather than on the data frame.
+
+    Set `row_local` if gate() decides whether to discard each event based only 
+    on that event, and not on the rest of the data.  This allows 
+    run_all_processing_steps() to combine the gate with other such gates.
+    """
+    kind = 'gate'
+    row_local = False
 
     def process_well(self, experiment, well):
+        if well.data.empty:
+            return
+
         selection = self.gate(experiment, well)
 
         if selection is not None:
-            if self.verbose:
-                num_events = len(selection)
-                num_kept = num_events - sum(selection)
-                gate_name = self.__class__.__name__
-                print("{} ({}): {}/{}".format(gate_name, well.label, num_kept, len(selection)))
+            selection = self.check_selection(well, selection)
 
-            return well.data.drop(well.data.index[selection])
+            self.report(well, len(selection) - selection.sum(), len(selection))
+            return well.data.iloc[~selection]
 
-    def gate(self, experiment, well):
+    def gate(self, experiment, well):   # (abstract)
         raise NotImplementedError
 
+    def channels_read(self):
+        """
+        Return the channels that gate() depends on, or None if it may depend 
+        on any of them.
+        """
+        return None
+
+    def check_selection(self, well, selection):
+        # A mask of the wrong shape would still index the data frame (e.g. a 
+        # 2D mask gets flattened), just not correctly, so reject it here.
+        selection = np.asarray(selection, dtype=bool)
+        if selection.shape != (len(well.data),):
+            raise ValueError("{}.gate() returned a selection with shape {}, expected ({},).".format(self.__class__.__name__, selection.shape, len(well.data)))
+        return selection
+
+    def report(self, well, num_kept, num_events):
+        if self.verbose:
+            gate_name = self.__class__.__name__
+            print("{} ({}): {}/{}".format(gate_name, well.label, num_kept, num_events))
+
 
 class GateNonPositiveEvents(GatingStep):
+    fusable = True
+    can_reorder = True
+    row_local = True
 
     def __init__(self, channels=None):
-        self.channels = None
+        self.channels = channels
+
+    def channels_read(self):
+        return self.channels or None
 
     def gate(self, experiment, well):
-        channels = self.channels or well.data.columns
-        masks = [well.data[channel] <= 0 for channel in channels]
-        return np.any(np.vstack(masks), axis=0)
+        # Only select columns if a subset of channels was requested; otherwise 
+        # use the whole data frame without building a new one.  Convert the 
+        # channels to a list, because pandas would treat a tuple as the name 
+        # of a single column.
+        data = well.data[list(self.channels)] if self.channels else well.data
+
+        # If numexpr is installed, evaluate all the comparisons in one pass 
+        # over the original columns, without copying them into a block first.  
+        # Take the columns by position, because names can be repeated.  
+        # numexpr can't take more than 32 operands, though.
+        if numexpr is not None and data.shape[1] <= 32:
+            columns = {
+                    'c{}'.format(i): data.iloc[:, i].to_numpy()
+                    for i in range(data.shape[1])
+            }
+            expr = ' | '.join('({} <= 0)'.format(x) for x in columns)
+            return numexpr.evaluate(expr, local_dict=columns)
+
+        return np.any(data.to_numpy() <= 0, axis=1)
+
+
+class LogTransformAndGate(GatingStep):
+    """
+    Discard events that are non-positive in any of the given channels, then 
+    log-transform those channels.
+
+    For a given list of channels, this is equivalent to 
+    GateNonPositiveEvents(channels) followed by LogTransformation(channels) 
+    (including raising a KeyError if any of the channels are missing), but it 
+    only reads the channels out of the data frame once.  Unlike 
+    GateNonPositiveEvents, it does nothing if no channels are given, because 
+    there would be nothing to log-transform.
+    """
+    fusable = True
+
+    def __init__(self, channels=None):
+        self.channels = channels or []
+
+    def process_well(self, experiment, well):
+        if not self.channels or well.data.empty:
+            return
+
+        # pandas would treat a tuple as the name of a single column.
+        channels = list(self.channels)
+
+        block = well.data[channels].to_numpy()
+        selection = np.any(block <= 0, axis=1)
+        self.report(well, len(selection) - selection.sum(), len(selection))
+
+        # Gate the data frame first, so only the surviving events need to be 
+        # transformed.  Use take() rather than a boolean iloc, because its 
+        # result owns its data even without copy-on-write (pandas < 3), so the 
+        # transformed values can be written straight into it without either 
+        # another copy or a SettingWithCopyWarning.
+
+        data = well.data.take(np.flatnonzero(~selection))
+
+        for group, block in _float_blocks(data, channels):
+            _log10_in_place(block)
+            data[group] = block
+
+        return data
 
 
 class GateSmallCells(GatingStep):
+    fusable = True
 
     def __init__(self, threshold=40, save_size_col=False):
         self.threshold = threshold
         self.save_size_col = save_size_col
 
     def gate(self, experiment, well):
-        from scipy.stats import linregress
-        fsc, ssc = well.data['FSC-A'], well.data['SSC-A']
-        m, b, *quality = linregress(fsc, ssc)
-        sizes = fsc + m * ssc
+        fsc, ssc = well.data['FSC-A'].to_numpy(), well.data['SSC-A'].to_numpy()
+
+        # Only the slope of the regression line is needed, so calculate it 
+        # directly (in double precision) rather than with linregress().
+        dx = fsc.astype(float) - fsc.mean(dtype=float)
+        dy = ssc.astype(float) - ssc.mean(dtype=float)
+        m = (dx @ dy) / (dx @ dx)
+
+        # Add FSC into the scaled SSC array in place, so only one temporary 
+        # array is allocated.
+        sizes = m * ssc
+        sizes += fsc
+
         if self.save_size_col:
             well.data['FSC-A + m * SSC-A'] = sizes
         return sizes < np.percentile(sizes, self.threshold)
 
+    @property
+    def can_reorder(self):
+        # The size column would be added before steps that were supposed to 
+        # see the data without it (e.g. KeepRelevantChannels).
+        return not self.save_size_col
+
+    def channels_read(self):
+        return ['FSC-A', 'SSC-A']
+
 
 class GateEarlyEvents(GatingStep):
+    fusable = True
+    can_reorder = True
+    row_local = True
 
     def __init__(self, throwaway_secs=2):
         self.throwaway_secs = throwaway_secs
 
+    def process_well(self, experiment, well):
+        # Events are recorded in order, so the early events are normally just 
+        # the first rows of the data frame.  In that case, find where they end 
+        # with a binary search instead of comparing every event to the 
+        # threshold.  Otherwise, fall back on the usual boolean mask.
+        time = well.data['Time'] if 'Time' in well.data else None
+
+        if time is None or not time.is_monotonic_increasing:
+            return super().process_well(experiment, well)
+
+        cut = np.searchsorted(time.to_numpy(), self.threshold(well))
+        self.report(well, len(time) - cut, len(time))
+
+        # Copy the slice, like every other gate does.  Otherwise (before 
+        # pandas 3) it would be a view sharing memory with the ungated data, 
+        # and would keep all of that data alive.
+        return well.data.iloc[cut:].copy()
+
+    def channels_read(self):
+        return ['Time']
+
     def gate(self, experiment, well):
-        secs = well.data['Time'] * float(well.meta.get('$TIMESTEP', 0.1))
-        return secs < self.throwaway_secs
+        return well.data['Time'].to_numpy() < self.threshold(well)
+
+    def threshold(self, well):
+        # Convert the threshold into time steps, rather than converting every 
+        # event into seconds.
+        timestep = float(well.meta.get('$TIMESTEP', 0.1))
+
+        # With a time step of 0, every event happens at 0 seconds, so either 
+        # all of them or none of them are thrown away.
+        if timestep == 0:
+            return np.inf if self.throwaway_secs > 0 else -np.inf
+
+        return self.throwaway_secs / timestep
+
+
+def _float_blocks(data, channels):
+    # Make a floating-point copy of the given channels, which can then be 
+    # transformed in place without allocating any other temporary arrays.  
+    # Channels with different types are copied separately, so that each keeps 
+    # its own precision (e.g. float32 isn't promoted to float64 just because 
+    # another channel is float64).  Integer channels become float64.
+    groups = {}
+
+    for channel, dtype in data[channels].dtypes.items():
+        groups.setdefault(dtype, []).append(channel)
+
+    for dtype, group in groups.items():
+        block = data[group].to_numpy()
+        yield group, block.astype(dtype if dtype.kind == 'f' else float)
+
+def _log10_in_place(block, use_log1p=False):
+    # log10(1 + x) is defined at x=0, which is sometimes more useful than 
+    # having those events become -inf.
+    if use_log1p:
+        np.log1p(block, out=block)
+        block /= np.log(10)
+
+    # If numexpr is installed, use it for the plain logarithm.  It works 
+    # through the array in cache-sized chunks using multiple threads, which 
+    # is typically a few times faster than np.log10().
+    elif numexpr is not None:
+        numexpr.evaluate('log10(block)', out=block)
+
+    else:
+        np.log10(block, out=block)
@@ -29,8 +29,10 @@ setup(
         'pandas',
         'pathlib',
         'pyyaml',
-        'scipy',
     ],
+    extras_require={
+        'numexpr': ['numexpr'],
+    },
     license='MIT',
     zip_safe=False,
     keywords=[
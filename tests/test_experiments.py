@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import pytest, fcmcmp, pandas as pd
+import pytest, fcmcmp, shutil, pandas as pd
 from pathlib import Path
 
 dummy_data = Path(__file__).parent / 'dummy_data'
@@ -17,6 +17,22 @@ def test_well_repr():
     well = fcmcmp.Well('A1', None, None)
     assert repr(well) == 'Well(A1)'
 
+def test_well_cursor_eq():
+    well = fcmcmp.WellCursor96(0, 0, 0, None)
+    assert well == 'A1'
+    assert well == 'A01'
+    assert not well == 'B1'
+    assert not well == 'foo/A1'
+
+    well = fcmcmp.WellCursor96(0, 7, 11, 'foo')
+    assert well == 'foo/H12'
+    assert not well == 'H12'
+
+    with pytest.raises(fcmcmp.UsageError):
+        well == 'I1'
+    with pytest.raises(fcmcmp.UsageError):
+        well == 'A123'
+
 def test_empty_file():
     with pytest.raises(fcmcmp.UsageError) as exc_info:
         fcmcmp.load_experiments(dummy_data / 'empty_file.yml')
@@ -97,6 +113,66 @@ def test_multiple_experiments():
 
     check_wells(experiments, before=['A1'], after=['B1'])
 
+def test_shared_wells():
+    experiments = fcmcmp.load_experiments(dummy_data / 'multiple_experiments.yml')
+
+    gfp_before = experiments[0]['wells']['before'][0]
+    rfp_before = experiments[1]['wells']['before'][0]
+
+    assert gfp_before is not rfp_before
+    assert gfp_before.data is not rfp_before.data
+    assert gfp_before.data.equals(rfp_before.data)
+
+def test_parallel_parsing():
+    experiments = fcmcmp.load_experiments(
+            dummy_data / 'specify_both_plates.yml', workers=2)
+
+    assert experiments[0]['label'] == 'sgNull'
+    assert experiments[0]['channel'] == 'FSC-A'
+
+    check_wells(experiments,
+            before=['p1/A1', 'p2/A1'], after=['p1/B1', 'p2/B1'])
+
+def test_dtype():
+    experiments = fcmcmp.load_experiments(dummy_data / 'plate_1.yml')
+    for experiment, condition, well in fcmcmp.yield_wells(experiments):
+        assert (well.data.dtypes == 'float32').all()
+
+    experiments = fcmcmp.load_experiments(
+            dummy_data / 'plate_1.yml', dtype='float64')
+    for experiment, condition, well in fcmcmp.yield_wells(experiments):
+        assert (well.data.dtypes == 'float64').all()
+
+def test_non_ascii_config(tmp_path):
+    config_path = tmp_path / 'non_ascii.yml'
+    config_path.write_bytes('''\
+plate: {}
+---
+label: sgGFP µ
+channel: FITC-A
+wells:
+    before: [A1]
+    after: [B1]
+'''.format(dummy_data / 'plate_1').encode('utf-8'))
+
+    experiments = fcmcmp.load_experiments(config_path)
+
+    assert experiments[0]['label'] == 'sgGFP µ'
+    check_wells(experiments, before=['A1'], after=['B1'])
+
+def test_lazy_loading():
+    experiments = fcmcmp.load_experiments(
+            dummy_data / 'plate_1.yml', lazy=True)
+
+    assert experiments[0]['label'] == 'sgGFP'
+    assert experiments[0]['channel'] == 'FITC-A'
+
+    well = experiments[0]['wells']['before'][0]
+    assert well._loader is not None
+
+    check_wells(experiments, before=['A1'], after=['B1'])
+    assert well._loader is None
+
 def test_external_reference():
     experiments = fcmcmp.load_experiments(dummy_data / 'external_reference.yml')
 
@@ -105,14 +181,68 @@ def test_external_reference():
 
     check_wells(experiments, before=['A1'], after=['B1'])
 
-def test_python_config():
-    experiments = fcmcmp.load_experiments(dummy_data / 'plate_1.py')
+def copy_python_config(tmp_path):
+    # Work on a copy, so the cache isn't written into the source tree.
+    shutil.copy(str(dummy_data / 'plate_1.py'), str(tmp_path))
+    shutil.copytree(str(dummy_data / 'plate_1'), str(tmp_path / 'plate_1'))
+    return tmp_path / 'plate_1.py'
+
+def test_python_config(tmp_path):
+    config_path = copy_python_config(tmp_path)
+    experiments = fcmcmp.load_experiments(config_path)
 
     assert experiments[0]['label'] == 'sgGFP'
     assert experiments[0]['channel'] == 'FITC-A'
+    assert not (tmp_path / 'plate_1.py.yml').exists()
 
     check_wells(experiments, before=['A1'], after=['B1'])
 
+def test_python_config_cache(tmp_path):
+    config_path = copy_python_config(tmp_path)
+    cache_path = tmp_path / 'plate_1.py.yml'
+
+    fcmcmp.load_experiments(config_path, cache=True)
+    assert cache_path.exists()
+
+    experiments = fcmcmp.load_experiments(config_path, cache=True)
+
+    assert experiments[0]['label'] == 'sgGFP'
+    assert experiments[0]['channel'] == 'FITC-A'
+
+    check_wells(experiments, before=['A1'], after=['B1'])
+
+    # The cache is used as long as it's newer than the script, unless caching 
+    # is turned off.
+    cache_path.write_text(cache_path.read_text().replace('sgGFP', 'cached'))
+
+    experiments = fcmcmp.load_experiments(config_path, cache=True)
+    assert experiments[0]['label'] == 'cached'
+
+    experiments = fcmcmp.load_experiments(config_path)
+    assert experiments[0]['label'] == 'sgGFP'
+
+def test_load_plates():
+    plates = fcmcmp.load_plates(dummy_data / 'specify_both_plates.yml')
+    assert plates == {
+            'p1': dummy_data / 'plate_1',
+            'p2': dummy_data / 'plate_2',
+    }
+
+    plates = fcmcmp.load_plates(dummy_data / 'specify_plate_1.yml')
+    assert plates == {None: dummy_data / 'plate_1'}
+
+    plates = fcmcmp.load_plates(dummy_data / 'plate_1.yml')
+    assert plates == {None: dummy_data / 'plate_1'}
+
+def test_iter_experiment_labels():
+    labels = fcmcmp.iter_experiment_labels(
+            dummy_data / 'multiple_experiments.yml')
+    assert list(labels) == ['sgGFP', 'sgRFP']
+
+    # Labels can be listed even if the wells don't exist.
+    labels = fcmcmp.iter_experiment_labels(dummy_data / 'nonexistent_well.yml')
+    assert list(labels) == ['sgGFP']
+
 def test_load_experiment():
     gfp_experiment = fcmcmp.load_experiment(
             dummy_data / 'multiple_experiments.yml', 'sgGFP')
@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 
-import pytest, fcmcmp, pandas as pd
+import pytest, fcmcmp, numpy as np, pandas as pd
 from nonstdlib import approx
+from functools import lru_cache
+
+@lru_cache()
+def _proto_df(items):
+    # Use single precision, like the data loaded from real FCS files.
+    df = pd.DataFrame.from_dict(dict(items))
+    return df.astype({x: 'float32' for x in df.select_dtypes('number')})
 
 def dummy_data(data):
-    df = pd.DataFrame.from_dict(data)
+    # Build each distinct data frame only once, and give every test its own 
+    # copy to modify.
+    df = _proto_df(tuple((k, tuple(v)) for k, v in data.items())).copy()
     well = fcmcmp.Well('A1', {}, df)
     experiment = {
             'label': 'dummy',
@@ -36,7 +45,18 @@ def test_keep_relevant_channels():
     keep_relevant_channels.channels = ['FSC-A']
     keep_relevant_channels(experiments)
 
-    assert well.data.columns == ['FSC-A']
+    assert list(well.data.columns) == ['FSC-A']
+
+    data = well.data
+    keep_relevant_channels(experiments)
+    assert well.data is data
+
+def test_constructor_arguments():
+    assert fcmcmp.KeepRelevantChannels(['FSC-A']).channels == ['FSC-A']
+    assert fcmcmp.LogTransformation(['FITC-A']).channels == ['FITC-A']
+    assert fcmcmp.GateNonPositiveEvents(['FITC-A']).channels == ['FITC-A']
+    assert fcmcmp.GateSmallCells(threshold=50).threshold == 50
+    assert fcmcmp.GateEarlyEvents(throwaway_secs=4).throwaway_secs == 4
 
 def test_log_transformation():
     experiments, well = dummy_data({
@@ -51,6 +71,70 @@ def test_log_transformation():
     assert well.data['FSC-A'].tolist() == approx([100, 200, 300, 400, 500, 600])
     assert well.data['FITC-A'].tolist() == approx([0, 1, 2, 3, 4, 5])
 
+def test_log_transformation_mixed_dtypes():
+    experiments, well = dummy_data({
+        'FSC-A': [1, 10, 100],
+        'FITC-A': [1, 10, 100],
+    })
+    well.data['FSC-A'] = well.data['FSC-A'].astype('float64')
+
+    log_transformation = fcmcmp.LogTransformation(['FSC-A', 'FITC-A'])
+    log_transformation(experiments)
+
+    assert well.data['FSC-A'].dtype == 'float64'
+    assert well.data['FITC-A'].dtype == 'float32'
+    assert well.data['FSC-A'].tolist() == approx([0, 1, 2])
+    assert well.data['FITC-A'].tolist() == approx([0, 1, 2])
+
+def test_log_transformation_integer_channels():
+    experiments, well = dummy_data({'FSC-A': []})
+    well.data = pd.DataFrame({
+        'FSC-A': pd.Series([1, 10, 100], dtype='float32'),
+        'FITC-A': pd.Series([1, 10, 100], dtype='int64'),
+        'PE-A': pd.Series([1, 10, 100], dtype='int32'),
+    })
+
+    log_transformation = fcmcmp.LogTransformation(['FSC-A', 'FITC-A', 'PE-A'])
+    log_transformation(experiments)
+
+    assert well.data['FSC-A'].dtype == 'float32'
+    assert well.data['FITC-A'].dtype == 'float64'
+    assert well.data['PE-A'].dtype == 'float64'
+    assert well.data['FSC-A'].tolist() == approx([0, 1, 2])
+    assert well.data['FITC-A'].tolist() == approx([0, 1, 2])
+    assert well.data['PE-A'].tolist() == approx([0, 1, 2])
+
+def test_log_transform_and_gate_integer_channels():
+    experiments, well = dummy_data({'FSC-A': []})
+    well.data = pd.DataFrame({
+        'FSC-A': pd.Series([1, 10, -1, 100], dtype='float32'),
+        'FITC-A': pd.Series([1, 10, 10, 100], dtype='int64'),
+    })
+
+    log_transform_and_gate = fcmcmp.LogTransformAndGate(['FSC-A', 'FITC-A'])
+    log_transform_and_gate(experiments)
+
+    assert well.data['FSC-A'].dtype == 'float32'
+    assert well.data['FITC-A'].dtype == 'float64'
+    assert well.data['FSC-A'].tolist() == approx([0, 1, 2])
+    assert well.data['FITC-A'].tolist() == approx([0, 1, 2])
+
+def test_log_transformation_without_numexpr(monkeypatch):
+    monkeypatch.setattr(fcmcmp.processing, 'numexpr', None)
+    test_log_transformation()
+
+def test_log_transformation_log1p():
+    experiments, well = dummy_data({
+        'FITC-A': [0, 9, 99, 999],
+    })
+
+    log_transformation = fcmcmp.LogTransformation()
+    log_transformation.channels = ['FITC-A']
+    log_transformation.use_log1p = True
+    log_transformation(experiments)
+
+    assert well.data['FITC-A'].tolist() == approx([0, 1, 2, 3])
+
 def test_gate_nonpositive_events():
     experiments, well = dummy_data({
         'FSC-A':  [-1,-1,-1, 0, 0, 0, 1, 1, 1],
@@ -64,6 +148,69 @@ def test_gate_nonpositive_events():
     assert well.data['FSC-A'].tolist() == [-1, 0, 1]
     assert well.data['FITC-A'].tolist() == [1, 1, 1]
 
+def test_log_transform_and_gate():
+    experiments, well = dummy_data({
+        'FSC-A':  [-1, 0, 1, 1, 1],
+        'FITC-A': [10, 10, -1, 0, 10],
+    })
+
+    log_transform_and_gate = fcmcmp.LogTransformAndGate()
+    log_transform_and_gate.channels = ['FITC-A']
+    log_transform_and_gate(experiments)
+
+    assert well.data['FSC-A'].tolist() == [-1, 0, 1]
+    assert well.data['FITC-A'].tolist() == approx([1, 1, 1])
+
+    experiments, well = dummy_data({
+        'FSC-A':  [-1, 1, 10],
+        'FITC-A': [10, 10, 10],
+    })
+
+    log_transform_and_gate.channels = 'FSC-A', 'FITC-A'
+    log_transform_and_gate(experiments)
+
+    assert well.data['FSC-A'].tolist() == approx([0, 1])
+    assert well.data['FITC-A'].tolist() == approx([1, 1])
+
+    log_transform_and_gate.channels = ['PE-A']
+    with pytest.raises(KeyError):
+        log_transform_and_gate(experiments)
+
+def test_gate_nonpositive_events_tuple():
+    experiments, well = dummy_data({
+        'FSC-A':  [-1, 1, 1],
+        'FITC-A': [ 1,-1, 1],
+        'PE-A':   [-1,-1, 1],
+    })
+
+    gate_nonpositive = fcmcmp.GateNonPositiveEvents(('FSC-A', 'FITC-A'))
+    gate_nonpositive(experiments)
+
+    assert well.data['PE-A'].tolist() == [1]
+
+def test_gate_nonpositive_events_without_numexpr(monkeypatch):
+    monkeypatch.setattr(fcmcmp.processing, 'numexpr', None)
+    test_gate_nonpositive_events()
+
+def test_gate_nonpositive_events_repeated_channels():
+    experiments, well = dummy_data({'a': [1, -1, 1]})
+    well.data = pd.DataFrame([[1, 1], [-1, 1], [1, 0]], columns=['a', 'a'])
+
+    gate_nonpositive = fcmcmp.GateNonPositiveEvents()
+    gate_nonpositive(experiments)
+
+    assert well.data.values.tolist() == [[1, 1]]
+
+def test_gate_wrong_shape():
+    experiments, well = dummy_data({'a': [1, 2, 3]})
+
+    class BadGate(fcmcmp.GatingStep):
+        def gate(self, experiment, well):
+            return [[True, False, False], [False, False, False]]
+
+    with pytest.raises(ValueError):
+        BadGate()(experiments)
+
 def test_gate_small_cells():
     experiments, well = dummy_data({
         'FSC-A': [1, 2, 3, 4, 5],
@@ -103,6 +250,96 @@ def test_gate_early_events():
 
     assert well.data['Time'].tolist() == [2, 3, 4, 5]
 
+def test_gate_early_events_copy():
+    experiments, well = dummy_data({
+        'Time':  [0, 1, 2, 3, 4, 5],
+    })
+    well.meta['$TIMESTEP'] = '2'
+    data = well.data
+
+    gate_early_events = fcmcmp.GateEarlyEvents()
+    gate_early_events.throwaway_secs = 4
+    gate_early_events(experiments)
+
+    assert well.data['Time'].tolist() == [2, 3, 4, 5]
+    assert not np.shares_memory(well.data['Time'].to_numpy(), data['Time'].to_numpy())
+
+def test_gate_early_events_zero_timestep():
+    experiments, well = dummy_data({
+        'Time':  [0, 1, 2, 3, 4, 5],
+    })
+    well.meta['$TIMESTEP'] = '0'
+
+    gate_early_events = fcmcmp.GateEarlyEvents()
+    gate_early_events.throwaway_secs = 0
+    gate_early_events(experiments)
+
+    assert well.data['Time'].tolist() == [0, 1, 2, 3, 4, 5]
+
+    gate_early_events.throwaway_secs = 4
+    gate_early_events(experiments)
+
+    assert well.data['Time'].tolist() == []
+
+def test_gate_early_events_unsorted():
+    experiments, well = dummy_data({
+        'Time':  [0, 5, 2, 3, 4, 1],
+    })
+    well.meta['$TIMESTEP'] = '2'
+
+    gate_early_events = fcmcmp.GateEarlyEvents()
+    gate_early_events.throwaway_secs = 4
+    gate_early_events(experiments)
+
+    assert well.data['Time'].tolist() == [5, 2, 3, 4]
+
+def test_workers():
+    experiments, well = dummy_data({
+        'FSC-A':  [-1,-1,-1, 0, 0, 0, 1, 1, 1],
+        'FITC-A': [-1, 0, 1,-1, 0, 1,-1, 0, 1],
+    })
+    other_well = fcmcmp.Well('A2', {}, well.data.copy())
+    experiments[0]['wells']['dummy'].append(other_well)
+
+    gate_nonpositive = fcmcmp.GateNonPositiveEvents()
+    gate_nonpositive.channels = ['FITC-A']
+    gate_nonpositive.workers = 2
+    gate_nonpositive(experiments)
+
+    for well_i in [well, other_well]:
+        assert well_i.data['FSC-A'].tolist() == [-1, 0, 1]
+        assert well_i.data['FITC-A'].tolist() == [1, 1, 1]
+
+def test_clear_all_processing_steps():
+    from fcmcmp.processing import _all_processing_steps
+
+    fcmcmp.GateEarlyEvents()
+    assert _all_processing_steps
+
+    fcmcmp.clear_all_processing_steps()
+    assert not _all_processing_steps
+
+def test_empty_well():
+    experiments, well = dummy_data({
+        'Time': [],
+        'FSC-A': [],
+        'SSC-A': [],
+        'FITC-A': [],
+    })
+
+    log_transformation = fcmcmp.LogTransformation()
+    log_transformation.channels = ['FITC-A']
+    log_transformation(experiments)
+
+    for gate in [
+            fcmcmp.GateNonPositiveEvents(),
+            fcmcmp.GateSmallCells(),
+            fcmcmp.GateEarlyEvents(),
+    ]:
+        gate(experiments)
+
+    assert well.data.empty
+
 def test_all_processing_steps():
     experiments, well = dummy_data({
         'Time':   [ 0, 1, 2, 3, 4, 5],
@@ -122,4 +359,138 @@ def test_all_processing_steps():
     assert well.data['Time'].tolist() == [2, 3]
     assert well.data['FITC-A'].tolist() == [1, 1]
 
+def test_all_processing_steps_unfusable():
+    experiments, well = dummy_data({
+        'Time':   [ 0, 1, 2, 3, 4, 5],
+        'FITC-A': [ 1, 1, 1, 1,-1,-1],
+    })
+    well.meta['$TIMESTEP'] = '2'
+
+    class CountExperiments(fcmcmp.ProcessingStep):
+
+        def __init__(self):
+            self.num_events = []
+
+        def process_experiment(self, experiment):
+            for condition, wells in experiment['wells'].items():
+                for well in wells:
+                    self.num_events.append(len(well.data))
+
+    fcmcmp.clear_all_processing_steps()
+
+    gate_nonpositive = fcmcmp.GateNonPositiveEvents()
+    gate_nonpositive.channels = ['FITC-A']
+    count_experiments = CountExperiments()
+    gate_early_events = fcmcmp.GateEarlyEvents()
+    gate_early_events.throwaway_secs = 4
+
+    fcmcmp.run_all_processing_steps(experiments)
+
+    assert count_experiments.num_events == [4]
+    assert well.data['Time'].tolist() == [2, 3]
+    assert well.data['FITC-A'].tolist() == [1, 1]
+
+def test_all_processing_steps_reordered():
+    experiments, well = dummy_data({
+        'Time':   [ 0, 1, 2, 3, 4, 5],
+        'FSC-A':  [ 1, 1, 1, 1, 1, 1],
+        'FITC-A': [ 1, 10, 100, 1000, 10000, 1],
+    })
+    well.meta['$TIMESTEP'] = '2'
+
+    fcmcmp.clear_all_processing_steps()
+
+    keep_relevant_channels = fcmcmp.KeepRelevantChannels(['Time', 'FITC-A'])
+    log_transformation = fcmcmp.LogTransformation(['FITC-A'])
+    gate_early_events = fcmcmp.GateEarlyEvents(4)
+    gate_nonpositive = fcmcmp.GateNonPositiveEvents(['FITC-A'])
+
+    # The early-events gate doesn't depend on either transformation, so it can 
+    # go first.  The non-positive gate depends on the log transformation, so 
+    # it has to stay after it.
+    assert fcmcmp.processing._schedule_steps(
+            fcmcmp.processing._all_processing_steps) == [
+                    gate_early_events,
+                    keep_relevant_channels,
+                    log_transformation,
+                    gate_nonpositive,
+    ]
+
+    fcmcmp.run_all_processing_steps(experiments)
+
+    assert list(well.data.columns) == ['Time', 'FITC-A']
+    assert well.data['Time'].tolist() == [2, 3, 4]
+    assert well.data['FITC-A'].tolist() == approx([2, 3, 4])
+
+def test_all_processing_steps_workers():
+    experiments, well = dummy_data({
+        'Time':   [ 0, 1, 2, 3, 4, 5],
+        'FITC-A': [ 1, 1, 1, 1,-1,-1],
+    })
+    well.meta['$TIMESTEP'] = '2'
+    other_well = fcmcmp.Well('A2', well.meta, well.data.copy())
+    experiments[0]['wells']['dummy'].append(other_well)
+
+    fcmcmp.clear_all_processing_steps()
+
+    gate_nonpositive = fcmcmp.GateNonPositiveEvents(['FITC-A'])
+    gate_early_events = fcmcmp.GateEarlyEvents(4)
+
+    fcmcmp.run_all_processing_steps(experiments, workers=2)
+
+    for well_i in [well, other_well]:
+        assert well_i.data['Time'].tolist() == [2, 3]
+        assert well_i.data['FITC-A'].tolist() == [1, 1]
+
+def test_all_processing_steps_sibling_wells():
+    experiments, well = dummy_data({
+        'a': [1, 10],
+    })
+    other_well = fcmcmp.Well('A2', {}, pd.DataFrame({'a': [1.0, 1000.0]}))
+    experiments[0]['wells']['dummy'].append(other_well)
+
+    class NormalizeToLastWell(fcmcmp.ProcessingStep):
+
+        def process_well(self, experiment, well):
+            last_well = experiment['wells']['dummy'][-1]
+            return well.data / last_well.data['a'].max()
+
+    fcmcmp.clear_all_processing_steps()
+
+    log_transformation = fcmcmp.LogTransformation(['a'])
+    normalize = NormalizeToLastWell()
+
+    # Custom steps may look at other wells, so they must not be applied to the 
+    # first well until every well has been log-transformed.
+    fcmcmp.run_all_processing_steps(experiments)
+
+    assert well.data['a'].tolist() == approx([0, 1/3])
+
+def test_all_processing_steps_explicit():
+    experiments, well = dummy_data({
+        'Time':   [ 0, 1, 2, 3, 4, 5],
+        'FITC-A': [ 1, 1, 1, 1,-1,-1],
+    })
+    well.meta['$TIMESTEP'] = '2'
+
+    class CountWells(fcmcmp.ProcessingStep):
+
+        def __init__(self):
+            self.num_wells = 0
+
+        def process_well(self, experiment, well):
+            self.num_wells += 1
+
+    fcmcmp.clear_all_processing_steps()
+
+    gate_nonpositive = fcmcmp.GateNonPositiveEvents(['FITC-A'])
+    gate_early_events = fcmcmp.GateEarlyEvents(4)
+    count_wells = CountWells()
+
+    # Only the given steps are run, and each only once.
+    fcmcmp.run_all_processing_steps(
+            experiments, steps=[gate_nonpositive, count_wells, count_wells])
 
+    assert count_wells.num_wells == 1
+    assert well.data['Time'].tolist() == [0, 1, 2, 3]
+    assert well.data['FITC-A'].tolist() == [1, 1, 1, 1]